@@ -1,8 +1,8 @@
 import streamlit as st
 from openai import OpenAI
 import os
-from data_processing import get_chroma_index_for_pdf, create_educational_vectordb, is_topic_nlp
-from chatbot import process_chat_message
+from data_processing import get_chroma_index_for_pdf, create_educational_vectordb, is_topic_nlp, get_vectordb_key
+from chatbot import process_chat_message, stream_response, get_rag_context, build_history_messages
 from study_materials import generate_study_materials, generate_downloads
 import re
 from test import conduct_rouge_tests
@@ -13,6 +13,9 @@ def initialize_session_state():
         st.session_state.openai_api_key = ""
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
+    if "history_summary" not in st.session_state:
+        st.session_state.history_summary = ""
+        st.session_state.history_summarized_count = 0
     if "uploaded_filenames" not in st.session_state:
         st.session_state.uploaded_filenames = ["An Introduction to Language and Linguistics.pdf"]
 
@@ -22,33 +25,21 @@ def is_valid_openai_key(api_key: str) -> bool:
     pattern = r'^sk-[A-Za-z0-9_-]+$'
     return bool(re.match(pattern, api_key))
 
-def is_nlp_topic(topic: str) -> bool:
+@st.cache_resource(show_spinner=False)
+def get_validated_client(api_key: str) -> OpenAI:
     """
-    Check if the topic is NLP-related.
+    Create an OpenAI client and validate the key with a minimal API call.
+    The client is cached per key, so only the first rerun pays for the round trip.
     
     Args:
-        topic: The topic to validate
+        api_key: The OpenAI API key
         
     Returns:
-        Boolean indicating if topic is NLP-related
+        OpenAI client for the key
     """
-    nlp_topics = {
-        "natural language processing", "nlp", "computational linguistics",
-        "text analysis", "language model", "machine learning", "deep learning",
-        "tokenization", "parsing", "text classification", "named entity recognition",
-        "sentiment analysis", "machine translation", "speech recognition",
-        "text generation", "information extraction", "word embeddings",
-        "language understanding", "text summarization", "question answering",
-        "topic modeling", "text mining", "semantic analysis", "syntactic analysis",
-        "corpus linguistics", "discourse analysis", "morphological analysis",
-        "part of speech tagging", "dependency parsing", "transformer models",
-        "bert", "gpt", "word2vec", "language representation", "text preprocessing",
-        "sequence labeling", "neural networks", "language generation",
-        "text similarity", "document classification", "information retrieval"
-    }
-    
-    topic_lower = topic.lower()
-    return any(t in topic_lower for t in nlp_topics)
+    client = OpenAI(api_key=api_key)
+    client.models.list()  # This will fail fast if the key is invalid
+    return client
 
 def main():
     st.set_page_config(page_title="📑 NLP Learning Plattform", layout="wide")
@@ -86,9 +77,8 @@ def main():
     try:
         #Set the environment variable for API key
         os.environ["OPENAI_API_KEY"] = api_key_input
-        # Test the API key with a minimal API call
-        client = OpenAI(api_key=api_key_input)
-        client.models.list()  # This will fail fast if the key is invalid
+        # Test the API key with a minimal API call (only once per key)
+        client = get_validated_client(api_key_input)
     except Exception as e:
         st.error(f"""
         Error validating OpenAI API key: The key format is correct, but the key appears to be invalid.
@@ -103,8 +93,6 @@ def main():
         st.stop()
     
     # If we get here, the key is valid
-    # Initialize OpenAI client with the provided key
-    client = OpenAI(api_key=api_key_input)
     
     # Title and description
     st.title("📑 NLP Learning Plattform")
@@ -121,8 +109,11 @@ def main():
         
         # Process uploaded files
         files, filenames = process_uploads(pdf_files)
-        vectordb, flagged_files = create_educational_vectordb(files, filenames)
+        vectordb, flagged_files, file_hashes = create_educational_vectordb(files, filenames)
         st.session_state["vectordb"] = vectordb
+        # Retrieval is restricted to these files, and its caches are scoped by them
+        st.session_state["vectordb_file_hashes"] = file_hashes
+        st.session_state["vectordb_key"] = get_vectordb_key(file_hashes)
         
         display_upload_status(flagged_files)
         
@@ -130,62 +121,7 @@ def main():
     tab1, tab2 = st.tabs(["💬 Chatbot", "📚 Study Material Generator"])
     
     with tab1:
-        # Create a container for chat history
-        chat_container = st.container()
-        
-        # Create a container for input at the bottom
-        input_container = st.container()
-        
-        # Display chat history in the chat container
-        with chat_container:
-            for message in st.session_state.chat_history:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
-        
-        # Chat input at the bottom
-        with input_container:
-            if prompt := st.chat_input("Ask anything about NLP:"):
-                st.session_state.chat_history.append({"role": "user", "content": prompt})
-                
-                # Update chat container with new user message
-                with chat_container:
-                    with st.chat_message("user"):
-                        st.markdown(prompt)
-                    
-                    # Get RAG context
-                    context = ""
-                    if vectordb:
-                        search_results = vectordb.similarity_search(prompt, k=3)
-                        for result in search_results:
-                            context += f"\n{result.page_content}\n[Source: {result.metadata.get('filename')}, Page: {result.metadata.get('page')}]\n"
-                    
-                    # Generate streaming response
-                    with st.chat_message("assistant"):
-                        message_placeholder = st.empty()
-                        full_response = ""
-                        start_time = time.time()
-                        
-                        for response in client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[
-                                {"role": "system", "content": "You are an educational AI assistant specializing in NLP. Base your responses on the provided context and cite sources when possible."},
-                                {"role": "assistant", "content": f"Context from documents: {context}"},
-                                *[{"role": m["role"], "content": m["content"]} for m in st.session_state.chat_history]
-                            ],
-                            stream=True,
-                        ):
-                            if response.choices[0].delta.content is not None:
-                                full_response += response.choices[0].delta.content
-                                message_placeholder.markdown(full_response + "▌")
-                                end_time = time.time()
-                                print(f"Time taken for the response: {end_time - start_time:.2f} seconds")
-                        
-                        message_placeholder.markdown(full_response)
-                        st.session_state.chat_history.append({"role": "assistant", "content": full_response})
-                    
-
-            # To run rouge tests, delete #
-            #conduct_rouge_tests(vectordb, client)   
+        render_chat(vectordb, client)
     
     with tab2:
         # Study material generation interface
@@ -210,19 +146,80 @@ def main():
                         """)
             else:
                 with st.spinner("Generating materials... This might take up to 1 minute. Please be patient 😇"):
-                    content = generate_study_materials(vectordb, topic, client)
-                    if content:
-                        generate_downloads(content) 
+                    st.session_state.study_materials = generate_study_materials(vectordb, topic, client)
+        
+        # Kept in the session state, because clicking a download button reruns the script
+        if st.session_state.get("study_materials"):
+            generate_downloads(st.session_state.study_materials)
 
         end_time = time.time()
         print(f"Time taken for generating learning materials: {end_time - start_time:.2f} seconds")                   
 
+@st.fragment
+def render_chat(vectordb, client):
+    """
+    Render the chat tab. As a fragment, chat interactions only rerun this function
+    instead of the whole script (sidebar and study material tab included).
+    
+    Args:
+        vectordb: The vector database for document search
+        client: The OpenAI client instance
+    """
+    # Create a container for chat history
+    chat_container = st.container()
+    
+    # Create a container for input at the bottom
+    input_container = st.container()
+    
+    # Display chat history in the chat container
+    with chat_container:
+        for message in st.session_state.chat_history:
+            with st.chat_message(message["role"]):
+                st.markdown(message["content"])
+    
+    # Chat input at the bottom
+    with input_container:
+        if prompt := st.chat_input("Ask anything about NLP:"):
+            st.session_state.chat_history.append({"role": "user", "content": prompt})
+            
+            # Update chat container with new user message
+            with chat_container:
+                with st.chat_message("user"):
+                    st.markdown(prompt)
+                
+                # Get RAG context
+                context = ""
+                if vectordb:
+                    context = get_rag_context(vectordb, prompt, st.session_state.vectordb_key)
+                
+                # Generate streaming response
+                with st.chat_message("assistant"):
+                    message_placeholder = st.empty()
+                    start_time = time.time()
+                    
+                    messages = [
+                        {"role": "system", "content": "You are an educational AI assistant specializing in NLP. Base your responses on the provided context and cite sources when possible."},
+                        {"role": "assistant", "content": f"Context from documents: {context}"},
+                        *build_history_messages(client)
+                    ]
+                    full_response = stream_response(client, messages, message_placeholder)
+                    end_time = time.time()
+                    print(f"Time taken for the response: {end_time - start_time:.2f} seconds")
+                    st.session_state.chat_history.append({"role": "assistant", "content": full_response})
+                
+
+        # To run rouge tests, delete # (use_batch=True runs them through the cheaper Batch API)
+        #conduct_rouge_tests(vectordb, client)   
+
+@st.cache_resource(show_spinner=False)
+def load_hardcoded_pdf() -> bytes:
+    """Read the default learning material once per process instead of on every rerun."""
+    with open("An_Introduction_to_Language_and_Linguistics.pdf", "rb") as f:
+        return f.read()
+
 def process_uploads(pdf_files):
     # Initialize with hardcoded document
-    with open("An_Introduction_to_Language_and_Linguistics.pdf", "rb") as f:
-        hardcoded_pdf_data = f.read()
-    
-    files = [hardcoded_pdf_data]
+    files = [load_hardcoded_pdf()]
     filenames = ["An Introduction to Language and Linguistics.pdf"]
     
     if pdf_files:
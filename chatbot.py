@@ -1,4 +1,182 @@
 import streamlit as st
+from openai import AsyncOpenAI
+import asyncio
+import queue
+import threading
+import time
+from data_processing import cached_similarity_search
+
+# Minimum number of seconds between two re-renders of a streaming answer
+stream_flush_interval = 0.04
+
+# Number of most recent chat messages that are always sent verbatim. Once twice
+# as many messages are unsummarized, the older ones are folded into the summary.
+history_window = 12
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """Start the background event loop that runs the async OpenAI streams."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def get_async_client(api_key: str) -> AsyncOpenAI:
+    """Create the async OpenAI client for a key, bound to the background event loop."""
+    return AsyncOpenAI(api_key=api_key)
+
+async def pump_stream(client: AsyncOpenAI, messages: list, tokens: queue.Queue):
+    """
+    Stream a chat completion and put its tokens into a queue, followed by None.
+    
+    Args:
+        client: The async OpenAI client instance
+        messages: Chat messages of the request
+        tokens: Queue receiving the tokens
+    """
+    try:
+        stream = await client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            stream=True,
+        )
+        async for response in stream:
+            if response.choices and response.choices[0].delta.content is not None:
+                tokens.put(response.choices[0].delta.content)
+    finally:
+        tokens.put(None)
+
+def stream_response(client, messages: list, message_placeholder) -> str:
+    """
+    Stream a chat completion into a placeholder. The network reads happen on a
+    background event loop, while this thread only drains the tokens and renders.
+    
+    Args:
+        client: The OpenAI client instance
+        messages: Chat messages of the request
+        message_placeholder: Streamlit placeholder showing the answer
+        
+    Returns:
+        The full response text
+    """
+    tokens = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        pump_stream(get_async_client(client.api_key), messages, tokens),
+        get_event_loop()
+    )
+    
+    # Collect tokens in a list, repeated string concatenation is quadratic
+    response_parts = []
+    finished = False
+    try:
+        while not finished:
+            # Wait for the next token, then drain everything arriving within one flush
+            # window so the answer re-renders at most ~25 times per second
+            token = tokens.get()
+            deadline = time.monotonic() + stream_flush_interval
+            while True:
+                if token is None:
+                    finished = True
+                    break
+                response_parts.append(token)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    token = tokens.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if not finished:
+                message_placeholder.markdown("".join(response_parts) + "▌")
+    finally:
+        # Stop the request if the script is interrupted mid-stream (rerun or closed
+        # tab), instead of reading the rest of the answer into an undrained queue
+        if not finished:
+            future.cancel()
+    
+    # Re-raise errors of the request
+    future.result()
+    
+    full_response = "".join(response_parts)
+    message_placeholder.markdown(full_response)
+    return full_response
+
+def summarize_history(client, previous_summary: str, messages: list) -> str:
+    """
+    Fold chat messages into a rolling summary of the conversation.
+    
+    Args:
+        client: The OpenAI client instance
+        previous_summary: Summary of the messages before these, may be empty
+        messages: Chat messages to add to the summary
+        
+    Returns:
+        The updated summary
+    """
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Summary so far: {previous_summary}\n\n{transcript}"
+    
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "Summarize this conversation between a user and an NLP tutor in a few sentences. Keep the topics, questions and key facts that follow-up questions may refer to."},
+            {"role": "user", "content": transcript}
+        ]
+    )
+    return response.choices[0].message.content.strip()
+
+def build_history_messages(client) -> list:
+    """
+    Build the conversation part of a chat request: a rolling summary of older turns
+    followed by the unsummarized messages, keeping the prompt size bounded.
+    
+    Args:
+        client: The OpenAI client instance
+        
+    Returns:
+        List of chat messages
+    """
+    history = st.session_state.chat_history
+    summarized_count = st.session_state.get("history_summarized_count", 0)
+    
+    if len(history) - summarized_count > 2 * history_window:
+        fold_until = len(history) - history_window
+        st.session_state.history_summary = summarize_history(
+            client,
+            st.session_state.get("history_summary", ""),
+            history[summarized_count:fold_until]
+        )
+        st.session_state.history_summarized_count = summarized_count = fold_until
+    
+    messages = []
+    if st.session_state.get("history_summary"):
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {st.session_state.history_summary}"})
+    messages.extend({"role": m["role"], "content": m["content"]} for m in history[summarized_count:])
+    return messages
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_rag_context(_vectordb, prompt: str, vectordb_key: str) -> str:
+    """
+    Search the vector database and build the RAG context with source references.
+    Cached per prompt, so reruns with the same prompt skip the query embedding call.
+    
+    Args:
+        _vectordb: The vector database for document search (not hashed)
+        prompt: The user's message
+        vectordb_key: Key of the ingested file contents, invalidates the cache on new uploads
+        
+    Returns:
+        Context string
+    """
+    search_results = cached_similarity_search(_vectordb, prompt, k=3)
+    
+    context_parts = []
+    for page_content, filename, page in search_results:
+        filename = filename if filename is not None else "unknown document"
+        page = page if page is not None else "unknown page"
+        context_parts.append(f"\n{page_content}\n[Source: {filename}, Page: {page}]\n")
+    return "".join(context_parts)
 
 def process_chat_message(user_input, vectordb, client):
     """
@@ -10,36 +188,18 @@ def process_chat_message(user_input, vectordb, client):
         client: The OpenAI client instance
     """
     if vectordb:
-        # Search in Chroma database
-        search_results = vectordb.similarity_search(user_input, k=3)
-        
-        # Construct RAG context with source references
-        context = ""
-        for result in search_results:
-            page_content = result.page_content
-            filename = result.metadata.get("filename", "unknown document")
-            page = result.metadata.get("page", "unknown page")
-            context += f"\n{page_content}\n[Source: {filename}, Page: {page}]\n"
+        # Search in Chroma database and construct RAG context with source references
+        context = get_rag_context(vectordb, user_input, st.session_state.vectordb_key)
         
         # Create message placeholder for streaming
         message_placeholder = st.empty()
-        full_response = ""
         
         # Generate streaming response with RAG context
-        for response in client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are an educational AI assistant specializing in NLP. Base your responses on the provided context and cite sources when possible."},
-                {"role": "assistant", "content": f"Context from documents: {context}"},
-                *[{"role": m["role"], "content": m["content"]} for m in st.session_state.chat_history]
-            ],
-            stream=True,
-        ):
-            if response.choices[0].delta.content is not None:
-                full_response += response.choices[0].delta.content
-                message_placeholder.markdown(full_response + "▌")
-        
-        message_placeholder.markdown(full_response)
-        return full_response
+        messages = [
+            {"role": "system", "content": "You are an educational AI assistant specializing in NLP. Base your responses on the provided context and cite sources when possible."},
+            {"role": "assistant", "content": f"Context from documents: {context}"},
+            *build_history_messages(client)
+        ]
+        return stream_response(client, messages, message_placeholder)
     
     return "I'm sorry, but I don't have access to the document database at the moment."
\ No newline at end of file
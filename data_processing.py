@@ -1,26 +1,67 @@
 import chromadb
-from chromadb.config import Settings
 from langchain.vectorstores import Chroma
 from langchain_openai import OpenAIEmbeddings
-from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from io import BytesIO
 from typing import List, Tuple
 import re
 import os
+import hashlib
+from functools import lru_cache
+from collections import OrderedDict
+import sqlite3
+import threading
+import json
+import time
 import streamlit as st
-from pypdf import PdfReader
+import fitz
 
 # Set the persistence directory within the current project folder
 persist_dir = os.path.join(os.path.dirname(__file__), "chroma_db")
-chroma_client = chromadb.Client(Settings(
-    persist_directory=persist_dir,
-    is_persistent=True
-))
 
+# Embeddings are truncated API-side (Matryoshka) to a third of the default size,
+# which shrinks the vectors scanned per query from 6 KB to 2 KB
+embedding_model = "text-embedding-3-small"
+embedding_dimensions = 512
+# Collections are tied to one embedding size, so the name tracks the dimensions
+collection_name = f"nlp_documents_{embedding_dimensions}"
+# Number of chunks embedded per OpenAI request
+embedding_batch_size = 512
+# Number of queries kept in the per-session retrieval cache
+retrieval_cache_size = 512
+# Retrieval results are also persisted next to the Chroma store, so they survive restarts
+retrieval_cache_path = os.path.join(persist_dir, "retrieval_cache.sqlite3")
+# Seconds after which persisted retrieval results are searched again
+retrieval_cache_ttl = 7 * 24 * 60 * 60
+
+# HNSW index parameters for the document collection. Chroma only applies these
+# when the collection is first created.
+# OpenAI embeddings are unit length (also when shortened with dimensions), so
+# inner product ranks like cosine without the per-distance norm computation
+hnsw_metadata = {
+    "hnsw:space": "ip",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100
+}
+
+# The splitter is stateless, so a single instance is shared by all pages
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=4000,
+    chunk_overlap=200,
+    separators=["\n\n", "\n", ".", " "]
+)
+
+# Page cleanup patterns, compiled once for all pages
+hyphenation_pattern = re.compile(r"(\w+)-\n(\w+)")
+single_newline_pattern = re.compile(r"(?<!\n\s)\n(?!\s\n)")
+blank_lines_pattern = re.compile(r"\n\s*\n")
+
+@st.cache_data(show_spinner=False)
 def parse_pdf(file: BytesIO, filename: str) -> List[Tuple[str, int]]:
     """
     Parse PDF file and extract text with proper cleanup.
+    Results are cached on the file contents, so unchanged files are only parsed once.
     
     Args:
         file: BytesIO object containing PDF data
@@ -29,47 +70,42 @@ def parse_pdf(file: BytesIO, filename: str) -> List[Tuple[str, int]]:
     Returns:
         List of tuples containing (text, page_number)
     """
-    pdf = PdfReader(file)
     output = []
-    for i, page in enumerate(pdf.pages):
-        text = page.extract_text()
-        # Clean up hyphenation and newlines
-        text = re.sub(r"(\w+)-\n(\w+)", r"\1\2", text)
-        text = re.sub(r"(?<!\n\s)\n(?!\s\n)", " ", text.strip())
-        text = re.sub(r"\n\s*\n", "\n\n", text)
-        output.append((text, i + 1))
+    # PyMuPDF's C extractor is several times faster than pure-Python pypdf
+    with fitz.open(stream=file.getvalue(), filetype="pdf") as pdf:
+        for i, page in enumerate(pdf):
+            text = page.get_text("text")
+            # Clean up hyphenation and newlines
+            text = hyphenation_pattern.sub(r"\1\2", text)
+            text = single_newline_pattern.sub(" ", text.strip())
+            text = blank_lines_pattern.sub("\n\n", text)
+            output.append((text, i + 1))
     return output
 
-def text_to_docs(text_pages: List[Tuple[str, int]], filename: str) -> List[Document]:
+def text_to_chunks(text_pages: List[Tuple[str, int]], filename: str, file_hash: str,
+                   texts: List[str], metadatas: List[dict]):
     """
-    Convert text pages to LangChain documents with metadata.
+    Split text pages into chunks and append them with their metadata to parallel lists.
     
     Args:
         text_pages: List of tuples containing (text, page_number)
         filename: Name of the source file
-        
-    Returns:
-        List of Document objects
+        file_hash: Content hash of the source file
+        texts: List receiving the chunk texts
+        metadatas: List receiving the chunk metadata, aligned with texts
     """
-    docs = []
     for text, page_number in text_pages:
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=4000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", ".", " "]
-        )
         chunks = text_splitter.split_text(text)
-        for i, chunk in enumerate(chunks):
-            doc = Document(
-                page_content=chunk,
-                metadata={
-                    "filename": filename,
-                    "page": page_number,
-                    "chunk": i
-                }
-            )
-            docs.append(doc)
-    return docs
+        texts.extend(chunks)
+        metadatas.extend(
+            {
+                "filename": filename,
+                "page": page_number,
+                "chunk": i,
+                "file_hash": file_hash
+            }
+            for i in range(len(chunks))
+        )
 
 @st.cache_resource
 def create_educational_vectordb(files, filenames):
@@ -81,11 +117,11 @@ def create_educational_vectordb(files, filenames):
         filenames: List of file names
         
     Returns:
-        Tuple of (vectordb, flagged_files)
+        Tuple of (vectordb, flagged_files, file_hashes), with the content hashes of the ingested files
     """
     with st.spinner("Creating vector database for all documents..."):
         try:
-            vectordb, flagged_files, successful_files = get_chroma_index_for_pdf(files, filenames, os.getenv("OPENAI_API_KEY"), persist_dir)
+            vectordb, flagged_files, successful_files, file_hashes = get_chroma_index_for_pdf(files, filenames, os.getenv("OPENAI_API_KEY"), persist_dir)
             if not vectordb:
                 st.error("Failed to create vector database.")
             else:
@@ -93,47 +129,80 @@ def create_educational_vectordb(files, filenames):
                 for filename in successful_files:
                     if filename not in st.session_state.uploaded_filenames:
                         st.session_state.uploaded_filenames.append(filename)
-            return vectordb, flagged_files
+            return vectordb, flagged_files, file_hashes
         except Exception as e:
             st.error(f"Error creating vector database: {e}")
-            return None, []
+            return None, [], []
 
-def get_chroma_index_for_pdf(files, filenames, openai_api_key: str, persist_directory: str):
+@lru_cache(maxsize=1)
+def get_chroma_client(persist_directory: str):
+    """Open the persistent Chroma store lazily, once per process."""
+    return chromadb.PersistentClient(path=persist_directory)
+
+@st.cache_resource(show_spinner=False)
+def get_vectordb(openai_api_key: str, persist_directory: str):
     """
-    Creates or updates Chroma index with provided PDF documents.
+    Create the Chroma vector store, reused across reruns and uploads.
     
     Args:
-        files: List of file contents
-        filenames: List of file names
         openai_api_key: OpenAI API key
         persist_directory: Directory for persisting the vector database
         
     Returns:
-        Tuple of (vectordb, flagged_files)
+        The Chroma vector database
     """
-    embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
+    embeddings = OpenAIEmbeddings(
+        model=embedding_model,
+        dimensions=embedding_dimensions,
+        chunk_size=embedding_batch_size,
+        openai_api_key=openai_api_key
+    )
     
     try:
-        vectordb = Chroma(
+        return Chroma(
             persist_directory=persist_directory,
             embedding_function=embeddings,
-            client=chroma_client,
-            collection_name="nlp_documents"
+            client=get_chroma_client(persist_directory),
+            collection_name=collection_name,
+            collection_metadata=hnsw_metadata
         )
     except Exception as e:
         raise RuntimeError(f"Failed to initialize Chroma with error: {e}")
+
+def get_chroma_index_for_pdf(files, filenames, openai_api_key: str, persist_directory: str):
+    """
+    Creates or updates Chroma index with provided PDF documents.
     
-    documents = []
+    Args:
+        files: List of file contents
+        filenames: List of file names
+        openai_api_key: OpenAI API key
+        persist_directory: Directory for persisting the vector database
+        
+    Returns:
+        Tuple of (vectordb, flagged_files, successful_files, file_hashes), with the
+        content hashes of the successful files
+    """
+    vectordb = get_vectordb(openai_api_key, persist_directory)
+    
+    # Chunks are collected as parallel lists and passed to Chroma as-is
+    texts = []
+    metadatas = []
     flagged_files = []
     successful_files = []
+    file_hashes = []
     
     for file, filename in zip(files, filenames):
         try:
+            # Chunks already stored from an earlier run are skipped by id in add_chunks_batched
+            file_hash = get_file_hash(file)
+            
             # Parse and check if file is NLP-relevant
             text_pages = parse_pdf(BytesIO(file), filename)
             if is_nlp_relevant(text_pages):
-                documents.extend(text_to_docs(text_pages, filename))
+                text_to_chunks(text_pages, filename, file_hash, texts, metadatas)
                 successful_files.append(filename)
+                file_hashes.append(file_hash)
             else:
                 flagged_files.append(filename)
         except Exception as e:
@@ -141,12 +210,150 @@ def get_chroma_index_for_pdf(files, filenames, openai_api_key: str, persist_dire
             flagged_files.append(filename)
 
     # Only add documents if there are new ones
-    if documents:
-        vectordb.add_documents(documents)
+    if texts:
+        add_chunks_batched(vectordb, vectordb.embeddings, texts, metadatas)
         
-    return vectordb, flagged_files, successful_files
+    return vectordb, flagged_files, successful_files, file_hashes
+
+def get_vectordb_key(file_hashes) -> str:
+    """
+    Return a key identifying the ingested file contents and the embedding setup,
+    used to scope retrieval caches. Content hashes rather than filenames, so a
+    changed file uploaded under an old name doesn't reuse the old results.
+    """
+    payload = "\n".join([collection_name, embedding_model, *sorted(set(file_hashes))])
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
 
-nlp_keywords = {
+def get_file_hash(file: bytes) -> str:
+    """Return a content hash identifying the file independently of its name."""
+    return hashlib.blake2b(file, digest_size=16).hexdigest()
+
+def get_chunk_id(text: str, metadata: dict) -> str:
+    """Derive a deterministic id for a chunk from its source file, position and text."""
+    text_hash = hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+    return f"{metadata['file_hash']}:{metadata['page']}:{metadata['chunk']}:{text_hash}"
+
+def add_chunks_batched(vectordb, embeddings, texts: List[str], metadatas: List[dict]):
+    """
+    Embed chunks in large batches and add them to the collection with precomputed vectors.
+    Chunks whose id is already stored are skipped, so they are never embedded twice.
+    
+    Args:
+        vectordb: The Chroma vector database
+        embeddings: Embedding model used for the chunks
+        texts: Chunk texts
+        metadatas: Chunk metadata, aligned with texts
+    """
+    collection = vectordb._collection
+    seen_ids = set()
+    for start in range(0, len(texts), embedding_batch_size):
+        batch_texts = texts[start:start + embedding_batch_size]
+        batch_metadatas = metadatas[start:start + embedding_batch_size]
+        batch_ids = [get_chunk_id(text, metadata) for text, metadata in zip(batch_texts, batch_metadatas)]
+        
+        # Only embed chunks that are neither stored nor already part of this upload
+        candidate_ids = list(dict.fromkeys(i for i in batch_ids if i not in seen_ids))
+        if candidate_ids:
+            seen_ids.update(collection.get(ids=candidate_ids, include=[])["ids"])
+        new_chunks = []
+        for chunk in zip(batch_ids, batch_texts, batch_metadatas):
+            if chunk[0] not in seen_ids:
+                seen_ids.add(chunk[0])
+                new_chunks.append(chunk)
+        if not new_chunks:
+            continue
+        
+        ids, new_texts, new_metadatas = map(list, zip(*new_chunks))
+        # One embedding request per batch instead of LangChain's per-call path
+        collection.add(
+            ids=ids,
+            embeddings=embeddings.embed_documents(new_texts),
+            metadatas=new_metadatas,
+            documents=new_texts
+        )
+
+def normalize_query(query: str) -> str:
+    """Lowercase a query and collapse its whitespace, so near-identical queries share a cache entry."""
+    return " ".join(query.lower().split())
+
+# Sessions run in separate threads, so they share one connection behind a lock
+retrieval_cache_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def get_retrieval_cache_db(path: str) -> sqlite3.Connection:
+    """Open the persistent retrieval cache lazily, once per process."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS query_results (key TEXT PRIMARY KEY, results TEXT NOT NULL, ts REAL NOT NULL)")
+    return db
+
+def load_persisted_results(key: str):
+    """Return the persisted results of a retrieval cache key, or None if missing or expired."""
+    with retrieval_cache_lock:
+        db = get_retrieval_cache_db(retrieval_cache_path)
+        row = db.execute(
+            "SELECT results FROM query_results WHERE key = ? AND ts >= ?",
+            (key, time.time() - retrieval_cache_ttl)
+        ).fetchone()
+    if row is None:
+        return None
+    return tuple(tuple(result) for result in json.loads(row[0]))
+
+def persist_results(key: str, results):
+    """Store the results of a retrieval cache key in the persistent cache, expiring old rows."""
+    now = time.time()
+    with retrieval_cache_lock:
+        db = get_retrieval_cache_db(retrieval_cache_path)
+        # Expired rows are removed on write, so lookups stay read-only
+        db.execute("DELETE FROM query_results WHERE ts < ?", (now - retrieval_cache_ttl,))
+        db.execute("INSERT OR REPLACE INTO query_results VALUES (?, ?, ?)", (key, json.dumps(results), now))
+        db.commit()
+
+def cached_similarity_search(vectordb, query: str, k: int = 3) -> Tuple[Tuple[str, object, object], ...]:
+    """
+    Run a similarity search, reusing the results of earlier identical or near-identical
+    queries instead of embedding the query and searching again. The search is restricted
+    to the session's ingested files, as the collection is shared by all sessions, so the
+    results can be kept in the session and persisted for a week across sessions and restarts.
+    
+    Args:
+        vectordb: The Chroma vector database
+        query: The search query
+        k: Number of results
+        
+    Returns:
+        Tuple of (page_content, filename, page) triples, with None for missing metadata
+    """
+    cache = st.session_state.setdefault("retrieval_cache", OrderedDict())
+    # Scoped by the ingested file contents, matching the filter of the search below
+    file_hashes = st.session_state.vectordb_file_hashes
+    if not file_hashes:
+        return ()
+    scope = f"{st.session_state.vectordb_key}:{k}"
+    exact_key = f"{scope}:exact:{query}"
+    normalized_key = f"{scope}:normalized:{hashlib.sha256(normalize_query(query).encode()).hexdigest()}"
+    
+    for key in (exact_key, normalized_key):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    
+    # Results of earlier sessions and processes, shared through the normalized key
+    results = load_persisted_results(normalized_key)
+    if results is None:
+        results = tuple(
+            (result.page_content, result.metadata.get("filename"), result.metadata.get("page"))
+            for result in vectordb.similarity_search(query, k=k, filter={"file_hash": {"$in": file_hashes}})
+        )
+        persist_results(normalized_key, results)
+    cache[exact_key] = cache[normalized_key] = results
+    # Every query holds an exact and a normalized entry
+    while len(cache) > 2 * retrieval_cache_size:
+        cache.popitem(last=False)
+    return results
+
+# Built once at import, shared by is_nlp_relevant and is_topic_nlp
+nlp_keywords = frozenset({
     "tokenization", "linguistics", "language", "parsing", "syntax", "semantic",
     "semantics", "nlp", "natural language processing", "computational linguistics",
     "text analysis", "language model", "machine translation", "translation",
@@ -184,7 +391,7 @@ nlp_keywords = {
     "affixation", "reduplication", "ablaut", "suppletion", 
     "derivation", "inflection", "projection", "merger",
     "adjunction", "movement", "binding theory", "head-complement order",
-    "thematic roles", "lexical semantics", "logical words", 
+    "thematic roles", "logical words", 
     "quantification", "indexicality", "context-dependency", "anaphora",
     "presupposition", "gricean maxims", "implicature", 
     "speech acts", "narratives", "participation frameworks",
@@ -194,7 +401,14 @@ nlp_keywords = {
     "neurolinguistics", "psycholinguistics", "parsing strategies",
     "syntactic ambiguity", "semantic ambiguity", "pragmatic inference",
     "collocations", "finite state automata", "context-free grammar"
-}
+})
+
+# Number of leading characters of a document scanned for keywords
+relevance_scan_chars = 50_000
+
+# Single alternation of all keywords, so the text is scanned once in C
+# instead of once per keyword
+nlp_keyword_pattern = re.compile("|".join(re.escape(keyword) for keyword in nlp_keywords))
 
 def is_nlp_relevant(text_pages: List[Tuple[str, int]]) -> bool:
     """
@@ -206,16 +420,27 @@ def is_nlp_relevant(text_pages: List[Tuple[str, int]]) -> bool:
     Returns:
         Boolean indicating if content is NLP-relevant
     """
-    
-    for text, _ in text_pages:
-        text_lower = text.lower()
-        if any(keyword in text_lower for keyword in nlp_keywords):
-            return True
-    return False
+    # One lowercase copy and one scan over the beginning of the document
+    text = "\n".join(text for text, _ in text_pages)[:relevance_scan_chars]
+    return bool(nlp_keyword_pattern.search(text.lower()))
 
-def is_topic_nlp(user_input: str) -> bool:
-    input_words = set(user_input.lower().split())  # Split input into individual words and normalize to lowercase
+# Single-word keywords are matched by set intersection with the input tokens,
+# multi-word and hyphenated keywords by one compiled alternation
+nlp_keyword_words = frozenset(k for k in nlp_keywords if re.fullmatch(r"\w+", k))
+nlp_keyword_phrases = re.compile(
+    r"\b(?:" + "|".join(re.escape(k) for k in nlp_keywords if k not in nlp_keyword_words) + r")\b"
+)
 
-    if input_words & nlp_keywords: # Intersection of two sets
-        return True
-    return False
\ No newline at end of file
+def is_topic_nlp(user_input: str) -> bool:
+    """
+    Check if the topic is NLP-related.
+    
+    Args:
+        user_input: The topic to validate
+        
+    Returns:
+        Boolean indicating if topic is NLP-related
+    """
+    topic_lower = user_input.lower()
+    tokens = set(re.findall(r"\w+", topic_lower))
+    return bool(tokens & nlp_keyword_words) or bool(nlp_keyword_phrases.search(topic_lower))
@@ -1,14 +1,87 @@
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.colors import Color, HexColor
+from reportlab.lib.enums import TA_CENTER
 from io import BytesIO
+from xml.sax.saxutils import escape
 
 def create_header_footer():
     """Create color for header and footer"""
     return HexColor('#1e88e5')
 
+# Styles are built once at import and shared by all generated PDFs. They are
+# flat, with the inherited sample stylesheet values inlined, so no parent style
+# is copied and attribute lookups don't walk a parent chain
+card_style = ParagraphStyle(
+    'CardStyle',
+    fontName='Helvetica',
+    fontSize=10,
+    leading=12,
+    alignment=TA_CENTER,
+    textColor=colors.black
+)
+
+title_style = ParagraphStyle(
+    'CustomTitle',
+    fontName='Helvetica-Bold',
+    fontSize=24,
+    leading=22,
+    alignment=TA_CENTER,
+    textColor=colors.black,
+    spaceAfter=15
+)
+
+heading_style = ParagraphStyle(
+    'CustomHeading',
+    fontName='Helvetica-Bold',
+    fontSize=14,
+    leading=22,
+    textColor=colors.black,
+    spaceBefore=8,
+    spaceAfter=4
+)
+
+body_style = ParagraphStyle(
+    'CustomBody',
+    fontName='Helvetica',
+    fontSize=10,
+    leading=12,
+    spaceBefore=4,
+    spaceAfter=4
+)
+
+flashcard_table_style = TableStyle([
+    ('BOX', (0, 0), (-1, -1), 1, colors.black),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('BACKGROUND', (0, 0), (0, 0), HexColor('#e3f2fd')),
+    ('BACKGROUND', (0, 1), (0, 1), HexColor('#bbdefb')),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+
+study_guide_table_style = TableStyle([
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('LEFTPADDING', (0, 0), (-1, -1), 10),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 10),
+])
+
+# Bottom padding takes the place of the spacer between flashcard rows
+flashcard_row_spacing = 8
+flashcard_grid_table_style = TableStyle([
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('LEFTPADDING', (0, 0), (-1, -1), 5),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 5),
+    ('TOPPADDING', (0, 0), (-1, -1), 0),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), flashcard_row_spacing),
+])
+
+def escape_markup(text):
+    """Escape text for Paragraph, whose mini-XML parser fails on stray '&', '<' and quotes."""
+    return escape(text, {'"': '&quot;', "'": '&apos;'})
+
 def create_flashcard(front, back, width, height):
     """
     Create a flashcard table with front and back content.
@@ -22,32 +95,25 @@ def create_flashcard(front, back, width, height):
     Returns:
         Table object representing the flashcard
     """
-    card_style = ParagraphStyle(
-        'CardStyle',
-        parent=getSampleStyleSheet()['Normal'],
-        fontSize=10,
-        leading=12,
-        alignment=1
-    )
-    
     data = [
-        [Paragraph(front, card_style)],
-        [Paragraph(f"Answer: {back}", card_style)]
+        [Paragraph(escape_markup(front), card_style)],
+        [Paragraph(f"Answer: {escape_markup(back)}", card_style)]
     ]
     
     card = Table(data, colWidths=[width], rowHeights=[height/2, height/2])
-    card.setStyle(TableStyle([
-        ('BOX', (0, 0), (-1, -1), 1, colors.black),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('BACKGROUND', (0, 0), (0, 0), HexColor('#e3f2fd')),
-        ('BACKGROUND', (0, 1), (0, 1), HexColor('#bbdefb')),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
+    card.setStyle(flashcard_table_style)
     return card
 
 def generate_pdf(content):
-    """Generate PDF with study materials."""
+    """
+    Generate PDF with study materials.
+    
+    Args:
+        content: Generated study materials
+        
+    Returns:
+        The PDF as bytes
+    """
     buffer = BytesIO()
     doc = SimpleDocTemplate(
         buffer,
@@ -58,42 +124,13 @@ def generate_pdf(content):
         bottomMargin=20
     )
     
-    styles = getSampleStyleSheet()
     story = []
     
-    # Define styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Title'],
-        fontSize=24,
-        textColor=colors.black,
-        spaceAfter=15
-    )
-    
-    heading_style = ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading1'],
-        fontSize=14,
-        textColor=colors.black,
-        spaceBefore=8,
-        spaceAfter=4
-    )
-    
-    body_style = ParagraphStyle(
-        'CustomBody',
-        parent=styles['Normal'],
-        fontSize=10,
-        leading=12,
-        spaceBefore=4,
-        spaceAfter=4
-    )
-    
     # Add title
-    story.append(Paragraph(content['title'], title_style))
+    story.append(Paragraph(escape_markup(content['title']), title_style))
     story.append(Spacer(1, 10))
     
     # Create two-column layout for study guide
-    study_guide_content = []
     sections = [
         ("Overview and Introduction", content['study_guide']['overview']),
         ("Core Concepts and Fundamentals", content['study_guide']['core_concepts']),
@@ -103,23 +140,22 @@ def generate_pdf(content):
         ("Future Directions and Trends", content['study_guide']['future_directions'])
     ]
     
-    for section_title, section_content in sections:
-        study_guide_content.append(Paragraph(section_title, heading_style))
-        study_guide_content.append(Paragraph(section_content, body_style))
-        study_guide_content.append(Spacer(1, 8))
+    # Fill the columns directly: first half of the sections left, second half right
+    left_column = []
+    right_column = []
+    half = len(sections) // 2
+    for index, (section_title, section_content) in enumerate(sections):
+        column = left_column if index < half else right_column
+        column.append(Paragraph(section_title, heading_style))
+        column.append(Paragraph(escape_markup(section_content), body_style))
+        column.append(Spacer(1, 8))
     
-    # Split content into two columns
     col_width = (doc.width - 40) / 2
     study_guide_table = Table(
-        [[study_guide_content[:len(study_guide_content)//2],
-          study_guide_content[len(study_guide_content)//2:]]],
+        [[left_column, right_column]],
         colWidths=[col_width, col_width]
     )
-    study_guide_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 10),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 10),
-    ]))
+    study_guide_table.setStyle(study_guide_table_style)
     story.append(study_guide_table)
     
     # Add flashcards in 3x4 grid
@@ -130,35 +166,34 @@ def generate_pdf(content):
     card_width = (doc.width - 60) / 3
     card_height = (doc.height - 80) / 4
     
-    # Create flashcard grid
-    for i in range(0, 12, 3):
-        row_cards = content['flashcards'][i:i+3]
-        card_row = []
-        for card in row_cards:
-            flashcard = create_flashcard(card['front'], card['back'], card_width, card_height)
-            card_row.append(flashcard)
-        
-        row_table = Table([card_row], 
-                         colWidths=[card_width] * 3,
-                         rowHeights=[card_height])
-        row_table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('LEFTPADDING', (0, 0), (-1, -1), 5),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 5),
-        ]))
-        story.append(row_table)
-        story.append(Spacer(1, 8))
+    # Build all flashcards (and their paragraphs) before assembling the grid
+    flashcards = [
+        create_flashcard(card['front'], card['back'], card_width, card_height)
+        for card in content['flashcards'][:12]
+    ]
+    
+    # Create flashcard grid as a single table, padding an incomplete last row
+    grid_rows = []
+    for i in range(0, len(flashcards), 3):
+        card_row = flashcards[i:i+3]
+        grid_rows.append(card_row + [''] * (3 - len(card_row)))
+    
+    if grid_rows:
+        grid_table = Table(grid_rows,
+                           colWidths=[card_width] * 3,
+                           rowHeights=[card_height + flashcard_row_spacing] * len(grid_rows))
+        grid_table.setStyle(flashcard_grid_table_style)
+        story.append(grid_table)
     
     # Add exercises
     story.append(PageBreak())
     story.append(Paragraph("Exercises", title_style))
     for i, exercise in enumerate(content['exercises'], 1):
         story.append(Paragraph(f"Exercise {i}:", heading_style))
-        story.append(Paragraph(exercise['question'], body_style))
+        story.append(Paragraph(escape_markup(exercise['question']), body_style))
         story.append(Spacer(1, 8))
         story.append(Paragraph("Solution:", heading_style))
-        story.append(Paragraph(exercise['solution'], body_style))
+        story.append(Paragraph(escape_markup(exercise['solution']), body_style))
         story.append(Spacer(1, 12))
     
     doc.build(story)
@@ -32,13 +32,6 @@ python -m pip install -r requirements.txt || (
     exit /b 1
 )
 
-echo Downloading NLTK data...
-python -c "import nltk; nltk.download('punkt'); nltk.download('averaged_perceptron_tagger'); nltk.download('stopwords')" || (
-    echo Error downloading NLTK data!
-    pause
-    exit /b 1
-)
-
 echo Starting Streamlit application...
 streamlit run app.py
 if errorlevel 1 (
@@ -20,13 +20,6 @@ python3 -m pip install -r requirements.txt || {
     exit 1
 }
 
-echo "Downloading NLTK data..."
-python3 -c "import nltk; nltk.download('punkt'); nltk.download('averaged_perceptron_tagger'); nltk.download('stopwords')" || {
-    echo "Error downloading NLTK data!"
-    read -p "Press enter to exit"
-    exit 1
-}
-
 echo "Starting Streamlit application..."
 streamlit run app.py || {
     echo "Error starting Streamlit application!"
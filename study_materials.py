@@ -1,32 +1,44 @@
 import streamlit as st
 import json
-from io import BytesIO, StringIO
-import base64
-import csv
-import genanki
-import random
+import orjson
+from io import BytesIO, TextIOWrapper
+import hashlib
 from pdf_generator import generate_pdf
-import matplotlib.pyplot as plt
+from data_processing import cached_similarity_search
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import re
 
-def generate_study_materials(vectordb, topic: str, client) -> dict:
-    """Generate structured study materials using OpenAI's chat completions."""
-    # Get relevant context from vector database
-    context = ""
-    if vectordb:
-        search_results = vectordb.similarity_search(topic, k=3)
-        for result in search_results:
-            context += f"\nFrom {result.metadata.get('filename', 'document')}, Page {result.metadata.get('page', 'unknown')}:\n"
-            context += f"{result.page_content}\n"
+# Shared by the exports started while streaming and the ones built afterwards
+export_executor = ThreadPoolExecutor(max_workers=4)
+# The exercises follow the flashcards in the response schema
+exercises_key_pattern = re.compile(r',\s*"exercises"\s*:')
+# Quizlet separates fields by tabs and cards by newlines, so both are blanked in the text
+quizlet_separator_table = str.maketrans({'\n': ' ', '\t': ' '})
+# Every generation has its own timestamp and thus its own cache entry, so only
+# the most recent exports are kept in memory; evicted ones are simply rebuilt
+export_cache_size = 16
+# Stable id of the Anki note model, so re-imported decks share one note type in Anki
+anki_model_id = 1607392319
+# Study guide sections in response order, with their headings
+study_guide_headings = {
+    'overview': "Overview and Introduction",
+    'core_concepts': "Core Concepts and Fundamentals",
+    'technical_details': "Technical Details and Methodology",
+    'practical_applications': "Practical Applications",
+    'challenges': "Challenges and Limitations",
+    'future_directions': "Future Directions and Trends"
+}
+# A study guide field followed by its complete, closed string value
+study_guide_field_pattern = re.compile(
+    r'"(' + "|".join(study_guide_headings) + r')"\s*:\s*"((?:[^"\\]|\\.)*)"'
+)
 
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an expert educational content creator and professor. Your primary task is to analyze the provided reference material and create comprehensive study materials based on it. Focus heavily on incorporating and expanding upon the concepts found in the reference documents."
-        },
-        {
-            "role": "user",
-            "content": f"""Based primarily on the following reference material, create detailed study materials about {topic}.
+# Prompts of the study materials request, defined once at import
+study_materials_system_prompt = "You are an expert educational content creator and professor. Your primary task is to analyze the provided reference material and create comprehensive study materials based on it. Focus heavily on incorporating and expanding upon the concepts found in the reference documents."
+# Only the topic and the reference material vary between requests
+study_materials_prompt_template = """Based primarily on the following reference material, create detailed study materials about {topic}.
 
             Reference Material:
             {context}
@@ -44,127 +56,271 @@ def generate_study_materials(vectordb, topic: str, client) -> dict:
             6. Future Directions and Trends
 
             Also include 12 flashcards and 4 exercises with detailed solutions."""
-        }
+
+# Structured output schema of the study materials request, built once at import
+study_materials_response_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "study_materials_response",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string"},
+                "study_guide": {
+                    "type": "object",
+                    "properties": {
+                        "overview": {"type": "string"},
+                        "core_concepts": {"type": "string"},
+                        "technical_details": {"type": "string"},
+                        "practical_applications": {"type": "string"},
+                        "challenges": {"type": "string"},
+                        "future_directions": {"type": "string"}
+                    },
+                    "required": ["overview", "core_concepts", "technical_details", 
+                                "practical_applications", "challenges", "future_directions"],
+                    "additionalProperties": False
+                },
+                "flashcards": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "front": {"type": "string"},
+                            "back": {"type": "string"}
+                        },
+                        "required": ["front", "back"],
+                        "additionalProperties": False
+                    }
+                },
+                "exercises": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "question": {"type": "string"},
+                            "solution": {"type": "string"}
+                        },
+                        "required": ["question", "solution"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["title", "study_guide", "flashcards", "exercises"],
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_topic_context(_vectordb, topic: str, vectordb_key: str) -> str:
+    """
+    Search the vector database and build the reference material for a topic.
+    Cached per topic, so reruns with the same topic skip the similarity search.
+    
+    Args:
+        _vectordb: The vector database for document search (not hashed)
+        topic: The study topic
+        vectordb_key: Key of the ingested file contents, invalidates the cache on new uploads
+        
+    Returns:
+        Context string
+    """
+    search_results = cached_similarity_search(_vectordb, topic, k=3)
+    
+    context_parts = []
+    for page_content, filename, page in search_results:
+        filename = filename if filename is not None else 'document'
+        page = page if page is not None else 'unknown'
+        context_parts.append(f"\nFrom {filename}, Page {page}:")
+        context_parts.append(page_content)
+    return "\n".join(context_parts) + "\n" if context_parts else ""
+
+def generate_study_materials(vectordb, topic: str, client) -> dict:
+    """Generate structured study materials using OpenAI's chat completions."""
+    # Get relevant context from vector database
+    context = ""
+    if vectordb:
+        context = get_topic_context(vectordb, topic, st.session_state.vectordb_key)
+
+    messages = [
+        {"role": "system", "content": study_materials_system_prompt},
+        {"role": "user", "content": study_materials_prompt_template.format(topic=topic, context=context)}
     ]
     
     try:
         response = client.chat.completions.create(
             model="gpt-4o",
             messages=messages,
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "study_materials_response",
-                    "schema": {
-                        "type": "object",
-                        "properties": {
-                            "title": {"type": "string"},
-                            "study_guide": {
-                                "type": "object",
-                                "properties": {
-                                    "overview": {"type": "string"},
-                                    "core_concepts": {"type": "string"},
-                                    "technical_details": {"type": "string"},
-                                    "practical_applications": {"type": "string"},
-                                    "challenges": {"type": "string"},
-                                    "future_directions": {"type": "string"}
-                                },
-                                "required": ["overview", "core_concepts", "technical_details", 
-                                            "practical_applications", "challenges", "future_directions"],
-                                "additionalProperties": False
-                            },
-                            "flashcards": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "front": {"type": "string"},
-                                        "back": {"type": "string"}
-                                    },
-                                    "required": ["front", "back"],
-                                    "additionalProperties": False
-                                }
-                            },
-                            "exercises": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "question": {"type": "string"},
-                                        "solution": {"type": "string"}
-                                    },
-                                    "required": ["question", "solution"],
-                                    "additionalProperties": False
-                                }
-                            }
-                        },
-                        "required": ["title", "study_guide", "flashcards", "exercises"],
-                        "additionalProperties": False
-                    },
-                    "strict": True
-                }
-            }
+            stream=True,
+            response_format=study_materials_response_format
         )
         
-        generated_content = json.loads(response.choices[0].message.content)
+        title = f"{topic} Study Guide"
+        
+        # The flashcards are complete once the exercises start streaming, so their
+        # exports are built in the background while the model is still writing
+        chunks = []
+        flashcard_futures = None
+        # Study guide sections are shown as soon as they are complete
+        preview = st.empty()
+        sections = {}
+        for chunk in response:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            chunks.append(chunk.choices[0].delta.content)
+            # A section can only complete with a closing quote
+            if len(sections) < len(study_guide_headings) and '"' in chunks[-1]:
+                completed = extract_completed_sections("".join(chunks))
+                if len(completed) > len(sections):
+                    sections = completed
+                    preview.markdown(render_partial_study_guide(sections))
+            # Only a fresh "exercises" token is worth a look at the whole response
+            if flashcard_futures is None and "exercises" in "".join(chunks[-4:]):
+                flashcard_futures = prebuild_flashcard_exports("".join(chunks), title)
+        
+        preview.empty()
+        generated_content = orjson.loads("".join(chunks))
         
-        current_time = datetime.now().strftime("%Y-%m-%d_%H-%M")
-        return {
-            'title': f"{topic} Study Guide",
-            'subtitle': f"Generated on {datetime.now().strftime('%B %d, %Y at %H:%M')}",
+        generated_at = datetime.now()
+        content = {
+            'title': title,
+            'subtitle': f"Generated on {generated_at.strftime('%B %d, %Y at %H:%M')}",
+            'generated_at': generated_at,
             'study_guide': generated_content['study_guide'],
             'flashcards': generated_content['flashcards'][:12],
             'exercises': generated_content['exercises'][:4]
         }
+        # Warms the export cache, generate_downloads then reuses the files
+        build_exports(get_content_key(content), content, flashcard_futures)
+        return content
     except Exception as e:
         st.error(f"Error generating study materials: {e}")
         return None
 
+def get_content_key(content) -> str:
+    """Return a hash identifying the generated study materials"""
+    payload = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+def extract_completed_sections(partial_json: str) -> dict:
+    """Return the study guide sections whose text is already complete in a partial response"""
+    return {
+        key: json.loads(f'"{value}"', strict=False)
+        for key, value in study_guide_field_pattern.findall(partial_json)
+    }
+
+def render_partial_study_guide(sections: dict) -> str:
+    """Render the completed study guide sections as markdown, in study guide order"""
+    return "\n\n".join(
+        f"#### {heading}\n{sections[key]}"
+        for key, heading in study_guide_headings.items() if key in sections
+    )
+
+def prebuild_flashcard_exports(partial_json: str, title: str):
+    """
+    Start building the flashcard exports from a partial study materials response.
+    
+    Args:
+        partial_json: The response streamed so far
+        title: Title of the study materials
+        
+    Returns:
+        Dict of export futures, or None while the flashcards are incomplete
+    """
+    match = exercises_key_pattern.search(partial_json)
+    if not match:
+        return None
+    try:
+        # Closing the object before the exercises gives a complete JSON document
+        flashcards = orjson.loads(partial_json[:match.start()] + "}")['flashcards'][:12]
+    except (ValueError, KeyError):
+        return {}
+    if not flashcards:
+        return {}
+    return {
+        'quizlet': export_executor.submit(generate_quizlet_format, flashcards),
+        'anki': export_executor.submit(generate_anki_deck, flashcards, title),
+        'csv': export_executor.submit(generate_csv_format, flashcards)
+    }
+
+# cache_resource hands out the cached files without pickling/copying them on every rerun
+@st.cache_resource(show_spinner=False, max_entries=export_cache_size)
+def build_exports(content_key, _content, _flashcard_futures=None):
+    """
+    Build all export files for the study materials.
+    Cached on the content hash, so reruns with unchanged content reuse the files.
+    
+    Args:
+        content_key: Hash of the study materials
+        _content: The study materials (not hashed)
+        _flashcard_futures: Flashcard exports already started while streaming (not hashed)
+    """
+    # The exports are independent, so they are built concurrently
+    futures = {'pdf': export_executor.submit(generate_pdf, _content)}
+    if _content['flashcards']:
+        if _flashcard_futures:
+            futures.update(_flashcard_futures)
+        else:
+            futures['quizlet'] = export_executor.submit(generate_quizlet_format, _content['flashcards'])
+            futures['anki'] = export_executor.submit(generate_anki_deck, _content['flashcards'], _content['title'])
+            futures['csv'] = export_executor.submit(generate_csv_format, _content['flashcards'])
+    
+    exports = {}
+    for name, future in futures.items():
+        if name == 'anki':
+            # A failed Anki export only disables its download
+            exports[name] = None if future.exception() else future.result()
+        else:
+            exports[name] = future.result()
+    return exports
+
 def generate_downloads(content):
     """Generate and display download buttons for study materials"""
-    pdf = generate_pdf(content)
+    exports = build_exports(get_content_key(content), content)
     st.success("Materials generated successfully!")
     
-    current_time = datetime.now().strftime("%Y-%m-%d_%H-%M")
+    # Named after the generation time, so the files keep their names across reruns
+    current_time = content['generated_at'].strftime("%Y-%m-%d_%H-%M")
     base_filename = f"NLP_material_{current_time}"
     
     st.markdown("### 📥 Download Materials")
-    st.markdown(get_download_link(pdf, f"{base_filename}.pdf", "📄 Download PDF Study Guide"), 
-               unsafe_allow_html=True)
+    st.download_button("📄 Download PDF Study Guide", data=exports['pdf'],
+                       file_name=f"{base_filename}.pdf", mime="application/pdf")
     
     if content['flashcards']:
         st.markdown("### 📱 Flashcard Exports")
         
-        quizlet_text = generate_quizlet_format(content['flashcards'])
-        st.markdown(get_download_link(quizlet_text, f"{base_filename}_quizlet.txt", "📚 Download for Quizlet Import"), 
-                   unsafe_allow_html=True)
+        st.download_button("📚 Download for Quizlet Import", data=exports['quizlet'],
+                           file_name=f"{base_filename}_quizlet.txt", mime="text/plain")
         
-        try:
-            anki_deck = generate_anki_deck(content['flashcards'], content['title'])
-            st.markdown(get_download_link(anki_deck, f"{base_filename}_anki.apkg", "🎴 Download Anki Deck"), 
-                       unsafe_allow_html=True)
-        except Exception as e:
+        if exports['anki'] is not None:
+            st.download_button("🎴 Download Anki Deck", data=exports['anki'],
+                               file_name=f"{base_filename}_anki.apkg", mime="application/octet-stream")
+        else:
             st.warning("Anki deck generation failed. You can still use the other export options.")
         
-        csv_content = generate_csv_format(content['flashcards'])
-        st.markdown(get_download_link(csv_content, f"{base_filename}_flashcards.csv", "📊 Download CSV"), 
-                   unsafe_allow_html=True)
+        st.download_button("📊 Download CSV", data=exports['csv'],
+                           file_name=f"{base_filename}_flashcards.csv", mime="text/csv")
     
     display_preview(content)
 
 def generate_quizlet_format(flashcards):
     """Generate a tab-separated format suitable for Quizlet import"""
-    output = StringIO()
-    for card in flashcards:
-        front = card['front'].replace('\n', ' ').replace('\t', ' ')
-        back = card['back'].replace('\n', ' ').replace('\t', ' ')
-        output.write(f"{front}\t{back}\n")
-    return output.getvalue()
+    # Built in one join and encoded once, instead of line by line
+    return "".join(
+        f"{card['front'].translate(quizlet_separator_table)}\t{card['back'].translate(quizlet_separator_table)}\n"
+        for card in flashcards
+    ).encode('utf-8')
 
-def generate_anki_deck(flashcards, deck_title):
-    """Generate an Anki deck from flashcards"""
-    model = genanki.Model(
-        random.randrange(1 << 30, 1 << 31),
+@lru_cache(maxsize=1)
+def get_anki_model():
+    """Build the Anki note model once per process, so its id and templates are reused"""
+    # Imported on first export only, to keep the app's cold start light
+    import genanki
+    
+    return genanki.Model(
+        anki_model_id,
         'Simple Model',
         fields=[{'name': 'Question'}, {'name': 'Answer'}],
         templates=[{
@@ -173,15 +329,17 @@ def generate_anki_deck(flashcards, deck_title):
             'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',
         }]
     )
+
+def generate_anki_deck(flashcards, deck_title):
+    """Generate an Anki deck from flashcards"""
+    import genanki
     
-    deck = genanki.Deck(random.randrange(1 << 30, 1 << 31), deck_title)
-    
-    for card in flashcards:
-        note = genanki.Note(
-            model=model,
-            fields=[card['front'], card['back']]
-        )
-        deck.add_note(note)
+    model = get_anki_model()
+    # Derived from the title, so regenerating a topic updates the same deck in Anki
+    # Masked to 30 bits first, so the id stays in genanki's [1 << 30, 1 << 31) range
+    deck_id = (int(hashlib.sha1(deck_title.encode()).hexdigest()[:8], 16) & ((1 << 30) - 1)) | (1 << 30)
+    deck = genanki.Deck(deck_id, deck_title)
+    deck.notes = [genanki.Note(model=model, fields=[card['front'], card['back']]) for card in flashcards]
     
     package = genanki.Package(deck)
     temp_file = BytesIO()
@@ -190,68 +348,41 @@ def generate_anki_deck(flashcards, deck_title):
 
 def generate_csv_format(flashcards):
     """Generate a CSV format of the flashcards"""
-    output = StringIO()
-    writer = csv.writer(output)
+    import csv
+    
+    output = BytesIO()
+    text_output = TextIOWrapper(output, encoding='utf-8', newline='', write_through=True)
+    writer = csv.writer(text_output)
     writer.writerow(['Front', 'Back'])
-    for card in flashcards:
-        writer.writerow([card['front'], card['back']])
+    writer.writerows([card['front'], card['back']] for card in flashcards)
+    # Detach so the wrapper doesn't close the buffer when it is collected
+    text_output.detach()
     return output.getvalue()
 
-def get_download_link(file_content, filename, display_text):
-    """Generate an HTML download link for file content"""
-    b64 = base64.b64encode(file_content.encode() if isinstance(file_content, str) else file_content).decode()
-    return f'<a href="data:application/octet-stream;base64,{b64}" download="{filename}" class="download-button">{display_text}</a>'
+@st.cache_data(show_spinner=False, max_entries=export_cache_size)
+def build_preview_markdown(content_key, _content) -> str:
+    """
+    Build the preview of the study materials as one markdown document.
+    Cached on the content hash, so reruns with unchanged content reuse it.
+    """
+    parts = [f"# {_content['title']}", _content['subtitle'], "## Study Guide"]
+    for key, heading in study_guide_headings.items():
+        parts.append(f"### {heading}")
+        parts.append(_content['study_guide'][key])
+    
+    if _content.get('flashcards'):
+        parts.append("## Flashcards")
+        for i, card in enumerate(_content['flashcards'], 1):
+            parts.extend([f"### Card {i}", "**Question:**", card['front'], "**Answer:**", card['back']])
+    
+    if _content.get('exercises'):
+        parts.append("## Practice Exercises")
+        for i, exercise in enumerate(_content['exercises'], 1):
+            parts.extend([f"### Exercise {i}", "**Question:**", exercise['question'], "**Solution:**", exercise['solution']])
+    return "\n\n".join(parts)
 
 def display_preview(content):
     """Display preview of generated content in Streamlit UI"""
     with st.expander("👀 Preview Generated Content"):
-        # Display title and subtitle
-        st.title(content['title'])
-        st.write(content['subtitle'])
-        
-        # Display study guide sections
-        st.header("Study Guide")
-        
-        # Overview and Introduction
-        st.subheader("Overview and Introduction")
-        st.write(content['study_guide']['overview'])
-        
-        # Core Concepts
-        st.subheader("Core Concepts and Fundamentals")
-        st.write(content['study_guide']['core_concepts'])
-        
-        # Technical Details
-        st.subheader("Technical Details and Methodology")
-        st.write(content['study_guide']['technical_details'])
-        
-        # Practical Applications
-        st.subheader("Practical Applications")
-        st.write(content['study_guide']['practical_applications'])
-        
-        # Challenges
-        st.subheader("Challenges and Limitations")
-        st.write(content['study_guide']['challenges'])
-        
-        # Future Directions
-        st.subheader("Future Directions and Trends")
-        st.write(content['study_guide']['future_directions'])
-        
-        # Display flashcards
-        if content.get('flashcards'):
-            st.header("Flashcards")
-            for i, card in enumerate(content['flashcards'], 1):
-                st.subheader(f"Card {i}")
-                st.write("**Question:**")
-                st.write(card['front'])
-                st.write("**Answer:**")
-                st.write(card['back'])
-        
-        # Display exercises
-        if content.get('exercises'):
-            st.header("Practice Exercises")
-            for i, exercise in enumerate(content['exercises'], 1):
-                st.subheader(f"Exercise {i}")
-                st.write("**Question:**")
-                st.write(exercise['question'])
-                st.write("**Solution:**")
-                st.write(exercise['solution'])
\ No newline at end of file
+        # One markdown element instead of ~50 separate writes
+        st.markdown(build_preview_markdown(get_content_key(content), content))
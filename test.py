@@ -1,5 +1,10 @@
 import streamlit as st
-from rouge import Rouge
+from rouge_score import rouge_scorer
+import asyncio
+import json
+import time
+from chatbot import get_event_loop, get_async_client
+from data_processing import cached_similarity_search
 
 test_questions_glossary = [
     "How would you define accent?",
@@ -17,33 +22,96 @@ correct_answers_glossary = {
     "How would you define treebank?" : "A corpus of sentences in a language that has been analyzed into parse trees.",
 }
 
+# Maximum number of test requests in flight at once
+max_concurrent_requests = 10
+# Seconds between two status checks of a ROUGE test batch
+batch_poll_interval = 30
+
 prompt_template = "You are an NLP expert. Answer questions clearly and concisely, referencing the uploaded materials when RAG is enabled."
 
 
+# Created once, instead of for every scored answer
+rouge = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+# Score names as reported by the tests
+rouge_score_names = {'rouge1': 'rouge-1', 'rouge2': 'rouge-2', 'rougeL': 'rouge-l'}
+
 def compute_rouge_scores(reference, candidate):
-    rouge = Rouge()
-    scores = rouge.get_scores(candidate, reference, avg=True)
-    return scores
+    scores = rouge.score(reference, candidate)
+    return {
+        rouge_score_names[name]: {"f": score.fmeasure, "p": score.precision, "r": score.recall}
+        for name, score in scores.items()
+    }
+
+async def ask(client, semaphore, messages):
+    async with semaphore:
+        response = await client.chat.completions.create(
+            model="gpt-4o", messages=messages, stream=False
+        )
+    return (response.choices[0].message.content or "").strip()
+
+async def ask_all(client, requests):
+    # Bounded, so the test run stays within the rate limits
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    return await asyncio.gather(*(ask(client, semaphore, messages) for messages in requests), return_exceptions=True)
+
+def get_custom_id(index):
+    # Requests alternate between the RAG and non-RAG prompt of each question
+    return f"{index // 2}-{'rag' if index % 2 == 0 else 'norag'}"
+
+def ask_all_batched(client, requests):
+    """Answer the requests through the Batch API, which is cheaper for offline test runs.
+    Returns the answers in request order, or None if the batch did not complete."""
+    # The batch id survives reruns, so an interrupted run resumes polling instead of resubmitting
+    batch_id = st.session_state.get("rouge_batch_id")
+    if batch_id is None:
+        lines = [
+            json.dumps({
+                "custom_id": get_custom_id(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": "gpt-4o", "messages": messages}
+            })
+            for i, messages in enumerate(requests)
+        ]
+        batch_file = client.files.create(file=("rouge_tests.jsonl", "\n".join(lines).encode()), purpose="batch")
+        batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        batch_id = st.session_state["rouge_batch_id"] = batch.id
+
+    with st.spinner("Waiting for the ROUGE test batch to complete..."):
+        batch = client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(batch_poll_interval)
+            batch = client.batches.retrieve(batch_id)
+    del st.session_state["rouge_batch_id"]
+
+    if batch.status != "completed" or batch.output_file_id is None:
+        st.error(f"ROUGE test batch {batch_id} {batch.status}")
+        return None
+
+    results = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") == 200:
+            results[result["custom_id"]] = (response["body"]["choices"][0]["message"]["content"] or "").strip()
+        else:
+            results[result["custom_id"]] = Exception(result.get("error") or response.get("body"))
+    return [results.get(get_custom_id(i), Exception("missing from the batch output")) for i in range(len(requests))]
 
-def conduct_rouge_tests(vectordb, client):
+def conduct_rouge_tests(vectordb, client, use_batch=False):
+    # Retrieve all contexts first, so the concurrent part only waits on the API
+    requests = []
     for question in test_questions_glossary:
-        
-        # Display each question (you can print this to console or log if needed)
-        st.write(f"Question: {question}")
-
-        # Add the question to the session history as if it were asked by the user
-        st.session_state["chat_history"].append({"role": "user", "content": question})
-        
         # Using RAG to search in Chroma database
-        search_results = vectordb.similarity_search(question, k=3)
+        search_results = cached_similarity_search(vectordb, question, k=3)
 
         # Constructing RAG context with source references
-        pdf_extract = ""
-        for result in search_results:
-            page_content = result.page_content
-            filename = result.metadata.get("filename", "unknown document")
-            page = result.metadata.get("page", "unknown page")
-            pdf_extract += f"{page_content} [Source: {filename}, Page: {page}]\n\n"
+        extract_parts = []
+        for page_content, filename, page in search_results:
+            filename = filename if filename is not None else "unknown document"
+            page = page if page is not None else "unknown page"
+            extract_parts.append(f"{page_content} [Source: {filename}, Page: {page}]\n\n")
+        pdf_extract = "".join(extract_parts)
 
         # Create a context-based prompt for RAG model
         prompt_with_rag = [
@@ -52,49 +120,52 @@ def conduct_rouge_tests(vectordb, client):
             {"role": "user", "content": question}
         ]
 
-        # Generate the response using RAG model
-        response_rag = []
-        for chunk in client.chat.completions.create(
-            model="gpt-4o", messages=prompt_with_rag, stream=True
-        ):
-            text = chunk.choices[0].delta.content
-            if text:
-                response_rag.append(text)
-        result_rag = "".join(response_rag).strip()
-        st.session_state["chat_history"].append({"role": "assistant", "content": result_rag})
-
-        
-        # Standard GPT-4o Mini without RAG
+        # Standard GPT-4o without RAG
         prompt_basic = [
             {"role": "system", "content": prompt_template},
             {"role": "user", "content": question}
         ]
-        response_gpt3 = []
-        for chunk in client.chat.completions.create(
-            model="gpt-4o", messages=prompt_basic, stream=True
-        ):
-            text = chunk.choices[0].delta.content
-            if text:
-                response_gpt3.append(text)
-        result_gpt3 = "".join(response_gpt3).strip()
-        st.session_state["chat_history"].append({"role": "assistant", "content": result_gpt3})
+        requests.extend((prompt_with_rag, prompt_basic))
+
+    if use_batch:
+        answers = ask_all_batched(client, requests)
+        if answers is None:
+            return
+    else:
+        # All RAG and non-RAG requests run concurrently on the chatbot's event loop
+        answers = asyncio.run_coroutine_threadsafe(
+            ask_all(get_async_client(client.api_key), requests),
+            get_event_loop()
+        ).result()
+
+    for i, question in enumerate(test_questions_glossary):
+        result_rag, result_gpt = answers[2 * i], answers[2 * i + 1]
+        for answer in (result_rag, result_gpt):
+            if isinstance(answer, Exception):
+                st.error(f"Error answering '{question}': {answer}")
+        result_rag = "" if isinstance(result_rag, Exception) else result_rag
+        result_gpt = "" if isinstance(result_gpt, Exception) else result_gpt
+
+        # Display each question (you can print this to console or log if needed)
+        st.write(f"Question: {question}")
+
+        # Add the question and answers to the session history as if it were asked by the user
+        st.session_state["chat_history"].append({"role": "user", "content": question})
+        st.session_state["chat_history"].append({"role": "assistant", "content": result_rag})
+        st.session_state["chat_history"].append({"role": "assistant", "content": result_gpt})
 
         # Get the correct answer for the current question
         correct_answer = correct_answers_glossary.get(question)
 
         # Compute ROUGE scores for RAG and GPT-4o responses
-        if result_rag:
-            rouge_scores_rag = compute_rouge_scores(correct_answer, result_rag)
-        else:
-            rouge_scores_rag = {"rouge-1": {"f": 0, "p": 0, "r": 0}}  # No RAG answer to compare
-
-        rouge_scores_no_rag = compute_rouge_scores(correct_answer, result_gpt3)
+        no_answer_scores = {"rouge-1": {"f": 0, "p": 0, "r": 0}}  # No answer to compare
+        rouge_scores_rag = compute_rouge_scores(correct_answer, result_rag) if result_rag else no_answer_scores
+        rouge_scores_no_rag = compute_rouge_scores(correct_answer, result_gpt) if result_gpt else no_answer_scores
 
         # Show the results to the user
         st.write(f"Answer (with RAG): {result_rag if result_rag else 'N/A'}")
-        st.write(f"Answer (without RAG): {result_gpt3}")
+        st.write(f"Answer (without RAG): {result_gpt if result_gpt else 'N/A'}")
         st.write(f"Correct Answer: {correct_answer}")
         st.write(f"ROUGE scores (with RAG): {rouge_scores_rag}")
         st.write(f"ROUGE scores (without RAG): {rouge_scores_no_rag}")
 
-